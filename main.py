@@ -1,13 +1,32 @@
 import os
-import json
-from datetime import datetime
+import re
+import hmac
+import asyncio
+import hashlib
+import multiprocessing
+import tempfile
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import List, Optional, Literal
-from fastapi import FastAPI, Header, HTTPException
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, Response
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, HttpUrl
-import requests
+import httpx
+import orjson
+import pypdfium2 as pdfium
 
 API_TOKEN = os.environ.get("API_BEARER_TOKEN")
-LOG_PATH = "/tmp/ingest_log.json"
+_EXPECTED_TOKEN = API_TOKEN.encode() if API_TOKEN else None
+LOG_PATH = "/tmp/ingest_log.jsonl"
+LOG_TAIL = 500  # entries returned by /ingest-log
+LOG_FLUSH_INTERVAL = 0.2  # seconds a log line may wait before being written
+LOG_FLUSH_BATCH = 32  # ...or flush as soon as this many are queued
 
 # Optional Zapier relay hooks (no-code)
 HOOKS = {
@@ -18,44 +37,139 @@ HOOKS = {
     "drive_ingest": os.environ.get("ZAPIER_HOOK_DRIVE_INGEST"),
 }
 
-app = FastAPI(title="Inspection Works Bridge API", version="1.1.0")
+
+# One shared async HTTP client for Zapier relays and PDF downloads.
+# Every hook lives on hooks.zapier.com, so pooled keep-alive connections
+# skip a TCP+TLS handshake per relay.
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=16, max_connections=32)
+HTTP_HEADERS = {"Content-Type": "application/json"}  # relay POSTs only, not PDF GETs
+
+
+# PDF text extraction is CPU-bound and runs in worker processes. Count the
+# cores this process may use (not the host's), and keep the default small
+# since every uvicorn worker gets its own pool.
+def _default_pdf_workers() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    return min(2, cores)
+
+
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS") or _default_pdf_workers())
+
+
+def _new_pdf_pool() -> ProcessPoolExecutor:
+    # Workers start lazily on the first parse, when the server is already
+    # multithreaded; forking then can deadlock the child on a lock held at
+    # fork time, so start them from a clean forkserver process instead
+    return ProcessPoolExecutor(
+        max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The pool may be replaced while running (see _extract_text_in_pool),
+    # so shut down whichever one is current at exit
+    app.state.pool = _new_pdf_pool()
+    try:
+        async with httpx.AsyncClient(limits=HTTP_LIMITS) as client:
+            app.state.http = client
+            app.state.log_queue = asyncio.Queue()
+            flusher = asyncio.create_task(_flush_ingest_log(app.state.log_queue))
+            try:
+                yield
+            finally:
+                app.state.log_queue.put_nowait(None)  # flush what's left, then stop
+                await flusher
+    finally:
+        app.state.pool.shutdown()
+
+
+app = FastAPI(
+    title="Inspection Works Bridge API",
+    version="1.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 # --- Security ---
-def _auth(authorization: Optional[str]):
-    if not API_TOKEN:
+# auto_error=False so a missing header keeps returning our 401, not a 403
+bearer = HTTPBearer(auto_error=False)
+
+
+async def require_token(cred: Optional[HTTPAuthorizationCredentials] = Depends(bearer)):
+    if _EXPECTED_TOKEN is None:
         raise HTTPException(500, "Server missing API_BEARER_TOKEN")
-    if not authorization or not authorization.startswith("Bearer "):
+    if cred is None:
         raise HTTPException(401, "Missing Bearer token")
-    token = authorization.split(" ", 1)[1]
-    if token != API_TOKEN:
+    if not hmac.compare_digest(cred.credentials.encode(), _EXPECTED_TOKEN):
         raise HTTPException(403, "Invalid token")
 
 
-# --- Helper: write to /tmp/ingest_log.json ---
+# --- Helper: append lines to /tmp/ingest_log.jsonl ---
 def _append_ingest_log(entry: dict):
+    app.state.log_queue.put_nowait(orjson.dumps(entry) + b"\n")
+
+
+def _write_ingest_log(lines: List[bytes]):
     try:
-        logs = []
-        if os.path.exists(LOG_PATH):
-            with open(LOG_PATH, "r") as f:
-                logs = json.load(f)
-        logs.append(entry)
-        with open(LOG_PATH, "w") as f:
-            json.dump(logs[-500:], f, indent=2)  # keep last 500 entries
+        with open(LOG_PATH, "ab") as f:
+            f.write(b"".join(lines))
     except Exception as e:
         print("Error writing log:", e)
 
 
-def _relay(name: str, payload: dict):
+async def _flush_ingest_log(queue: asyncio.Queue):
+    # Batch queued lines into one write per LOG_FLUSH_INTERVAL / LOG_FLUSH_BATCH
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await queue.get()
+        if line is None:
+            return
+        batch = [line]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_FLUSH_BATCH:
+            try:
+                line = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if line is None:
+                _write_ingest_log(batch)
+                return
+            batch.append(line)
+        _write_ingest_log(batch)
+
+
+def _to_json(payload: BaseModel) -> bytes:
+    # Serialize straight to JSON bytes in pydantic-core (no intermediate dict)
+    return payload.__pydantic_serializer__.to_json(payload)
+
+
+def _accepted(name: str, body: bytes) -> dict:
+    # Fragment embeds the already-serialized body without decoding it
+    return {"status": "ok", "message": f"{name} accepted", "echo": orjson.Fragment(body)}
+
+
+async def _relay(name: str, body: bytes):
     url = HOOKS.get(name)
     if url:
         try:
-            r = requests.post(url, json=payload, timeout=15)
+            r = await app.state.http.post(url, content=body, headers=HTTP_HEADERS, timeout=15)
             r.raise_for_status()
             return {"status": "ok", "relayed_to": name, "zapier_status": r.status_code, "zapier_body": r.text}
         except Exception as e:
             return {"status": "ok", "relayed_to": name, "zapier_error": str(e)}
-    return {"status": "ok", "message": f"{name} accepted", "echo": payload}
+    return _accepted(name, body)
+
+
+async def _relay_in_background(name: str, body: bytes):
+    # Nobody is waiting on the response any more, so surface failures in the log
+    result = await _relay(name, body)
+    if "zapier_error" in result:
+        print(f"Error relaying {name}:", result["zapier_error"])
 
 
 # --- Payload Models ---
@@ -115,63 +229,58 @@ class DriveIngestPayload(BaseModel):
 
 
 # --- Routes ---
-@app.get("/health")
-def health():
-    return {"status": "healthy"}
+_HEALTH_BYTES = b'{"status":"healthy"}'  # liveness probes: no per-request encoding
 
 
-@app.post("/invoice")
-def create_or_update_invoice(payload: InvoicePayload, authorization: Optional[str] = Header(None)):
-    _auth(authorization)
-    return _relay("invoice", payload.dict())
+@app.get("/health")
+async def health():
+    return Response(_HEALTH_BYTES, media_type="application/json")
+
 
+@app.post("/invoice", dependencies=[Depends(require_token)])
+async def create_or_update_invoice(payload: InvoicePayload):
+    return ORJSONResponse(await _relay("invoice", _to_json(payload)))
 
-@app.post("/payment")
-def record_payment(payload: PaymentPayload, authorization: Optional[str] = Header(None)):
-    _auth(authorization)
-    return _relay("payment", payload.dict())
 
+@app.post("/payment", dependencies=[Depends(require_token)])
+async def record_payment(payload: PaymentPayload):
+    return ORJSONResponse(await _relay("payment", _to_json(payload)))
 
-@app.post("/deposit")
-def create_deposit(payload: DepositPayload, authorization: Optional[str] = Header(None)):
-    _auth(authorization)
-    return _relay("deposit", payload.dict())
 
+@app.post("/deposit", dependencies=[Depends(require_token)])
+async def create_deposit(payload: DepositPayload):
+    return ORJSONResponse(await _relay("deposit", _to_json(payload)))
 
-@app.post("/close-package")
-def export_close_package(payload: ClosePackagePayload, authorization: Optional[str] = Header(None)):
-    _auth(authorization)
-    return _relay("close_package", payload.dict())
 
+@app.post("/close-package", dependencies=[Depends(require_token)])
+async def export_close_package(payload: ClosePackagePayload):
+    return ORJSONResponse(await _relay("close_package", _to_json(payload)))
 
-from datetime import datetime
 
-@app.post("/drive/ingest")
-def ingest_drive_file(payload: DriveIngestPayload, authorization: Optional[str] = Header(None)):
-    _auth(authorization)
+@app.post("/drive/ingest", dependencies=[Depends(require_token)])
+async def ingest_drive_file(payload: DriveIngestPayload, background: BackgroundTasks):
 
-    # Always log ingestion to local file
+    # Always log ingestion to local file (queued, written in batches)
     entry = {
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
         "file_url": str(payload.file_url),
         "file_type": payload.file_type,
     }
     _append_ingest_log(entry)
 
-    # Relay to Zapier if configured
-    result = _relay("drive_ingest", payload.dict())
+    # Relay to Zapier if configured, also after the response
+    body = _to_json(payload)
+    background.add_task(_relay_in_background, "drive_ingest", body)
+    result = _accepted("drive_ingest", body)
 
     # 🔁 Optional: automatically parse invoices when turned on
     if AUTO_PARSE_ON_INGEST and payload.file_type == "invoice_pdf":
         try:
-            parse_result = parse_invoice(payload, authorization)
-            result["auto_parse"] = parse_result["parsed"]
+            result["auto_parse"] = await _parse_invoice_pdf(str(payload.file_url))
         except Exception as e:
             result["auto_parse_error"] = str(e)
 
-    return result
-
-
+    return ORJSONResponse(result)
 
 
 @app.get("/ingest-log")
@@ -179,62 +288,101 @@ def get_ingest_log():
     """Return the list of ingested files (last 500 entries)."""
     if not os.path.exists(LOG_PATH):
         return {"entries": []}
-    with open(LOG_PATH, "r") as f:
-        logs = json.load(f)
-    return {"entries": logs}
+    with open(LOG_PATH, "rb") as f:
+        tail = deque(f, maxlen=LOG_TAIL)
+    return {"entries": [orjson.loads(line) for line in tail]}
 
-import io, re
-from pdfminer.high_level import extract_text
 
 # -----------------------------------------
 #  PDF Invoice Parser (Manual/Auto Mode)
 # -----------------------------------------
 
 AUTO_PARSE_ON_INGEST = False  # 🔁 flip to True later to automate parsing
+DOWNLOAD_CHUNK = 64 * 1024
+DOWNLOAD_TIMEOUT = httpx.Timeout(30, connect=5)
+MAX_PDF_BYTES = 25_000_000
+PARSED_CACHE_DIR = "/tmp/invoices/parsed_cache"  # parsed results keyed by PDF sha1
+PARSER_VERSION = "pdfium-2"  # bump when text extraction or the patterns change
+
+@lru_cache(maxsize=4)
+def _ensure_dir(path: str) -> str:
+    # mkdir(exist_ok=True) still stats every time; do it once per process
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _extract_text(data: bytes) -> str:
+    """Return the text of every page in the PDF (PDFium, C++)."""
+    pdf = pdfium.PdfDocument(data)
+    try:
+        return "\n".join(page.get_textpage().get_text_bounded() for page in pdf)
+    finally:
+        pdf.close()
 
-@app.post("/parse/invoice")
-def parse_invoice(payload: DriveIngestPayload, authorization: Optional[str] = Header(None)):
-    """Manually parse a Spectora invoice PDF and extract structured fields."""
-    _auth(authorization)
-
-    # 1. Download the PDF
-    r = requests.get(str(payload.file_url))
-    r.raise_for_status()
-    tmp_path = "/tmp/tmp_invoice.pdf"
-    with open(tmp_path, "wb") as f:
-        f.write(r.content)
-
-    # 2. Extract all text
-    text = extract_text(tmp_path)
 
-    # 3. Helper to extract text safely
+async def _extract_text_in_pool(data: bytes) -> str:
+    """Run _extract_text in the process pool, off the event loop."""
+    loop = asyncio.get_running_loop()
+    pool = app.state.pool
+    try:
+        return await loop.run_in_executor(pool, _extract_text, data)
+    except BrokenProcessPool:
+        # A worker died (PDFium crash, OOM kill) and the pool is unusable from
+        # now on. Swap in a fresh one, unless a concurrent request already did,
+        # but don't resubmit: this PDF may be the one that kills workers.
+        if app.state.pool is pool:
+            app.state.pool = _new_pdf_pool()
+            pool.shutdown(wait=False)
+        raise HTTPException(422, "PDF could not be parsed")
+
+
+# Field patterns, compiled once at import. Kept as separate searches on
+# purpose: one combined alternation scanned with finditer measured 4-20x
+# slower on a multi-page invoice, and it changes which match each field
+# gets (fields that start at the same offset shadow each other).
+_PAT_CLIENT = re.compile(r"Bill To\s*([A-Za-z\s']+)", re.IGNORECASE)
+_PAT_EMAIL = re.compile(r"([\w\.-]+@[\w\.-]+)", re.IGNORECASE)
+_PAT_PHONE = re.compile(r"(\d{3}[-\s]?\d{3}[-\s]?\d{4})", re.IGNORECASE)
+_PAT_PROPERTY = re.compile(r"Property\s*(.+?)\nDate", re.IGNORECASE)
+_PAT_DATE = re.compile(r"Date\s*([\d/]+)", re.IGNORECASE)
+_PAT_ORDER = re.compile(r"Order\s*(\d+)", re.IGNORECASE)
+_PAT_TOTAL = re.compile(r"TOTAL\s*CAD\$\s*([\d,\.]+)", re.IGNORECASE)
+_PAT_TECH_FEE = re.compile(r"Technology Fee.*CAD\$\s*([\d,\.]+)", re.IGNORECASE)
+_PAT_PAID = re.compile(r"Paid\s*\(.*\)\s*CAD\$\s*([\d,\.]+)", re.IGNORECASE)
+_PAT_GST = re.compile(r"GST.*CAD\$\s*([\d,\.]+)", re.IGNORECASE)
+# One line item per line: anchored and length-bounded, and the description
+# can't contain \n, so a long text without "CAD$" can't backtrack across lines
+_PAT_LINE = re.compile(r"^([A-Za-z][A-Za-z ]{0,80})\s*CAD\$\s*([\d,.]+)", re.MULTILINE)
+
+
+def _parse_invoice_text(text: str) -> dict:
+    """Pull the structured invoice fields out of the extracted PDF text."""
+    # Helper to extract text safely
     def find(pattern):
-        m = re.search(pattern, text, re.IGNORECASE)
+        m = pattern.search(text)
         return m.group(1).strip() if m else None
 
-    # 4. Parse key fields
-    client = find(r"Bill To\s*([A-Za-z\s']+)")
-    email = find(r"([\w\.-]+@[\w\.-]+)")
-    phone = find(r"(\d{3}[-\s]?\d{3}[-\s]?\d{4})")
-    property_addr = find(r"Property\s*(.+?)\nDate")
-    date = find(r"Date\s*([\d/]+)")
-    order = find(r"Order\s*(\d+)")
-    total = find(r"TOTAL\s*CAD\$\s*([\d,\.]+)")
-    tech_fee = find(r"Technology Fee.*CAD\$\s*([\d,\.]+)")
-    paid = find(r"Paid\s*\(.*\)\s*CAD\$\s*([\d,\.]+)")
-    gst = find(r"GST.*CAD\$\s*([\d,\.]+)")
-
-    # 5. Extract line items (skip tech fee)
-    lines = re.findall(r"([A-Za-z\s]+)\s*CAD\$\s*([\d,\.]+)", text)
-    items = []
-    for desc, amt in lines:
-        desc = desc.strip()
-        if desc.lower().startswith("technology fee"): 
-            continue
-        items.append({"description": desc, "amount": float(amt.replace(',', ''))})
-
-    # 6. Build structured result
-    result = {
+    # Parse key fields
+    client = find(_PAT_CLIENT)
+    email = find(_PAT_EMAIL)
+    phone = find(_PAT_PHONE)
+    property_addr = find(_PAT_PROPERTY)
+    date = find(_PAT_DATE)
+    order = find(_PAT_ORDER)
+    total = find(_PAT_TOTAL)
+    tech_fee = find(_PAT_TECH_FEE)
+    paid = find(_PAT_PAID)
+    gst = find(_PAT_GST)
+
+    # Extract line items (skip tech fee)
+    items = [
+        {"description": desc.strip(), "amount": float(amt.replace(',', ''))}
+        for desc, amt in _PAT_LINE.findall(text)
+        if not desc.lower().startswith("technology fee")
+    ]
+
+    # Build structured result
+    return {
         "client": client,
         "email": email,
         "phone": phone,
@@ -249,4 +397,65 @@ def parse_invoice(payload: DriveIngestPayload, authorization: Optional[str] = He
         "line_items": items
     }
 
-    return {"status": "ok", "parsed": result}
+
+async def _parse_invoice_pdf(file_url: str) -> dict:
+    """Download a Spectora invoice PDF and extract structured fields."""
+    # 1. Download the PDF into memory; PDFium parses it from bytes, so no temp file
+    chunks = []
+    digest = hashlib.sha1()
+    size = 0
+    async with app.state.http.stream(
+        "GET", file_url, follow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+    ) as r:
+        r.raise_for_status()
+        # Fail fast on a declared oversize body, and re-check as bytes arrive
+        # in case Content-Length is missing or wrong
+        if int(r.headers.get("Content-Length", 0)) > MAX_PDF_BYTES:
+            raise HTTPException(413, "PDF too large")
+        async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK):
+            size += len(chunk)
+            if size > MAX_PDF_BYTES:
+                raise HTTPException(413, "PDF too large")
+            digest.update(chunk)
+            chunks.append(chunk)
+
+    # Same bytes already parsed? Skip text extraction entirely.
+    cache_path = os.path.join(PARSED_CACHE_DIR, f"{PARSER_VERSION}-{digest.hexdigest()}.json")
+    try:
+        with open(cache_path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        pass  # missing or unreadable: parse again and overwrite
+
+    # 2. Extract all text (in the process pool, off the event loop)
+    text = await _extract_text_in_pool(b"".join(chunks))
+
+    # 3. Parse the fields (regex work is CPU-bound too; keep it off the loop)
+    result = await run_in_threadpool(_parse_invoice_text, text)
+
+    # Write to a temp file and rename, so a failed write never leaves a
+    # truncated entry behind under the real name
+    tmp_path = None
+    try:
+        _ensure_dir(PARSED_CACHE_DIR)
+        fd, tmp_path = tempfile.mkstemp(dir=PARSED_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(result))
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        _ensure_dir.cache_clear()  # e.g. /tmp was cleaned; recreate next time
+        print("Error writing parse cache:", e)
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    return result
+
+
+@app.post("/parse/invoice", dependencies=[Depends(require_token)])
+async def parse_invoice(payload: DriveIngestPayload):
+    """Manually parse a Spectora invoice PDF and extract structured fields."""
+    parsed = await _parse_invoice_pdf(str(payload.file_url))
+    return ORJSONResponse({"status": "ok", "parsed": parsed})